@@ -14,8 +14,31 @@ from .models import MonteCarloActionType
 EPSILON = 1e-16
 
 # Input and output sizes of the network
-INPUT_SIZE = 60  # (1 HP, 4 Moves) x 6 Pokemon x 2 Players
-OUTPUT_SIZE = 31  # 6 switches + 4 Moves x 6 Pokemon + 1 outcome value
+INPUT_SIZE = (1 + POKEMON_MOVE_LIMIT) * POKEMON_PARTY_LIMIT * 2  # (1 HP, 4 Moves) x 6 Pokemon x 2 Players = 60
+OUTPUT_SIZE = POKEMON_PARTY_LIMIT + POKEMON_MOVE_LIMIT * POKEMON_PARTY_LIMIT + 1  # 6 switches + 4 Moves x 6 Pokemon + 1 outcome value = 31
+
+
+class PredictedActionModel(RandomModel):
+    """
+    A model that takes the action chosen by the predictor, falling back to random forced switches.
+    """
+
+    def __init__(self, move_type: MonteCarloActionType, action: Union[Move, int]):
+        """
+        Initializes a PredictedActionModel.
+        :param move_type: Either MonteCarloActionType.ATTACK or MonteCarloActionType.SWITCH.
+        :param action: The Move to attack with or the index of the Pokemon to switch to.
+        """
+        self._move_type = move_type
+        self._action = action
+
+    def take_turn(self, player: Player, other_player: Player, attack: Callable[[Move], None],
+                  use_item: Callable[[Item], None],
+                  switch_pokemon_at_idx: Callable[[int], None]) -> None:
+        if self._move_type == MonteCarloActionType.ATTACK:
+            attack(self._action)
+        else:
+            switch_pokemon_at_idx(self._action)
 
 
 class Predictor:
@@ -25,6 +48,8 @@ class Predictor:
         Create an MLP model for training.
         """
         self._is_trained = False
+        self._layers: List[Tuple[np.ndarray, np.ndarray]] = []
+        self._input_buffer = np.empty(INPUT_SIZE, dtype=np.float32)
         self._model = MLPRegressor(
             hidden_layer_sizes=hidden_layer_sizes,
             activation='relu',
@@ -57,8 +82,19 @@ class Predictor:
         :param player: The player.
         :param other_player: The opposing player.
         """
+        # Sort the player's party once for both the input and the output
+        sorted_party = player.get_party().get_sorted_list()
+
+        # Stack the sample into contiguous 2D arrays so fit does not have to convert nested lists
+        inputs = np.stack([self._make_input_vector(player, other_player, sorted_party)]).astype(np.float32, copy=False)
+        outputs = np.stack([self._make_actual_output_list(player, node, sorted_party)]).astype(np.float32, copy=False)
+
         self._is_trained = True
-        self._model.fit([self._make_input_vector(player, other_player)], [self._make_actual_output_list(player, node)])
+        self._model.fit(inputs, outputs)
+
+        # Export the fitted weights once for inference
+        self._layers = [(np.ascontiguousarray(weights, dtype=np.float32), biases.astype(np.float32))
+                        for weights, biases in zip(self._model.coefs_, self._model.intercepts_)]
 
     def predict_move(self, player: Player, other_player: Player) -> Tuple[RandomModel, MonteCarloActionType, int, List[float], List[float]]:
         """
@@ -70,16 +106,16 @@ class Predictor:
         if not self._is_trained:
             return RandomModel(), MonteCarloActionType.ATTACK, 0, POKEMON_MOVE_LIMIT*[round(1/POKEMON_MOVE_LIMIT)], POKEMON_PARTY_LIMIT* [round(1/POKEMON_PARTY_LIMIT)]
 
-        input_matrix = self._make_input_vector(player, other_player)
-        output = self._model.predict([input_matrix])[0]
+        # Sort the player's party once for both the input and the output lookup
+        sorted_party = player.get_party().get_sorted_list()
+
+        input_matrix = self._make_input_vector(player, other_player, sorted_party, out=self._input_buffer)
+        output = self._forward(input_matrix)
 
         # Get the index of the 4 current Pokemon moves from the output
-        current_pokemon_id = player.get_party().get_starting().get_id()
-        current_pokemon_idx = -1
-        for idx, pokemon in enumerate(player.get_party().get_sorted_list()):
-            if pokemon.get_id() == current_pokemon_id:
-                current_pokemon_idx = idx
-                break
+        current_pokemon = player.get_party().get_starting()
+        id_to_sorted_idx = {pkmn.get_id(): i for i, pkmn in enumerate(sorted_party)}
+        current_pokemon_idx = id_to_sorted_idx.get(current_pokemon.get_id(), -1)
 
         # Create probabilities for picking moves and switches
         move_probs = []
@@ -88,174 +124,172 @@ class Predictor:
             move_probs = output[start_idx:start_idx + POKEMON_MOVE_LIMIT]
         switch_probs = output[:POKEMON_PARTY_LIMIT]
 
-        # Create the model
-        model = RandomModel()
-
         # Get probability of attacking and switching
         all_moves = list(np.concatenate((move_probs, switch_probs), axis=0))
         all_moves_probs = to_probs(all_moves)
         prob_attack = sum(all_moves_probs[:len(move_probs)])
         move_type = chance(prob_attack, MonteCarloActionType.ATTACK, MonteCarloActionType.SWITCH)
-        move_idx = 0
 
         # Randomly select a move given the move weights
         if move_type == MonteCarloActionType.ATTACK:
             # Get a random move
-            move_idx = chances(move_probs, list(range(len(player.get_party().get_starting().get_move_bank().get_as_list()))))
-            attack = player.get_party().get_starting().get_move_bank().get_move(move_idx)
-
-            # Create a turn function
-            def take_turn(_: Player, __: Player, do_move: Callable[[Move], None], ___: Callable[[Item], None],
-                          ____: Callable[[int], None]):
-                do_move(attack)
+            move_bank = current_pokemon.get_move_bank()
+            move_idx = chances(move_probs, list(range(len(move_bank.get_as_list()))))
 
             # Create the model
-            model.take_turn = take_turn
+            model = PredictedActionModel(move_type, move_bank.get_move(move_idx))
         else:
             # Get a random switch index
             move_idx = chances(switch_probs, [i for i, _ in enumerate(switch_probs)])
 
-            # Create a turn function
-            def take_turn(_: Player, __: Player, ___: Callable[[Move], None], ____: Callable[[Item], None],
-                          switch_pokemon: Callable[[int], None]):
-                switch_pokemon(move_idx)
-
             # Create the model
-            model.take_turn = take_turn
+            model = PredictedActionModel(move_type, move_idx)
 
         return model, move_type, move_idx, move_probs, switch_probs
 
+    def _forward(self, input_vector: np.ndarray) -> np.ndarray:
+        """
+        Runs a single input through the trained network. Equivalent to MLPRegressor.predict, but skips its per-call
+        input validation, which dominates the cost for a single small sample, and uses the float32 weights exported in
+        train_model.
+        :param input_vector: An input vector from _make_input_vector.
+        :return: The output vector of length OUTPUT_SIZE.
+        """
+        activation = input_vector
+        last_layer = len(self._layers) - 1
+        for i, (weights, biases) in enumerate(self._layers):
+            activation = activation @ weights
+            activation += biases
+            # Hidden layers use ReLU and the output layer uses the identity
+            if i < last_layer:
+                np.maximum(activation, 0, out=activation)
+        return activation
+
+    @staticmethod
+    def _split_output(output: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Splits an output vector, or a batch of output vectors, into its policy and value components.
+        :param output: An output vector of length OUTPUT_SIZE or an array of them with shape (n, OUTPUT_SIZE).
+        :return: A tuple containing the <switch and move probabilities, outcome values>.
+        """
+        return output[..., :-1], output[..., -1]
+
     @staticmethod
     def _calculate_loss(game_output: np.ndarray, output: np.ndarray):
         """
-        Calculates the loss between the output from searching and output from finishing the game.
-        :param game_output: The output from finishing the game.
-        :param output: The output from searching/learning.
-        :return: A float representing the loss.
+        Calculates the loss between the output from searching and output from finishing the game as the squared error
+        of the outcomes plus the cross-entropy of the policies, averaged over a batch.
+        :param game_output: The output from finishing the game, either a single output or a batch of outputs.
+        :param output: The output from searching/learning, with the same shape as game_output.
+        :return: A float representing the mean loss.
         """
+        search_probs, predicted_outcome = Predictor._split_output(output)
+        policy_probs, game_outcome = Predictor._split_output(game_output)
 
         # Calculate outcome component
-        predicted_outcome = output[-1]
-        game_outcome = game_output[-1]
         outcome_loss = np.square(game_outcome - predicted_outcome)
 
-        # Calculate policy component
-        search_probs = output[:-1]
-        policy_probs = game_output[:-1]
-        policy_comp = np.dot(search_probs, np.log(policy_probs))
+        # Calculate policy component, clipping to avoid taking the log of zero
+        policy_probs = np.clip(policy_probs, EPSILON, 1.0)
+        policy_comp = -np.sum(search_probs * np.log(policy_probs), axis=-1)
 
-        return outcome_loss + policy_comp
+        return float(np.mean(outcome_loss + policy_comp))
+
+    @staticmethod
+    def _split_input(input_vector: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Splits an input vector into views of its HP and PP components.
+        :param input_vector: An input vector of length INPUT_SIZE.
+        :return: A tuple containing the <HP ratio vector of shape (12,), PP ratio matrix of shape (12, 4)>.
+        """
+        num_pokemon = 2 * POKEMON_PARTY_LIMIT
+        return input_vector[:num_pokemon], input_vector[num_pokemon:].reshape(num_pokemon, POKEMON_MOVE_LIMIT)
 
     @staticmethod
-    def _make_input_vector(player: Player, other_player: Player) -> np.ndarray:
+    def _make_input_vector(player: Player, other_player: Player, sorted_party: Optional[List[Pokemon]] = None,
+                           out: Optional[np.ndarray] = None) -> np.ndarray:
         """
         Creates an input vector for the dense net.
         :param player: The focused player.
         :param other_player: The other player.
-        :return: A 60-len numpy array with [HP ratio, Move 1 PP ratio, ... Move 4 PP ratio] at each row for max 12 Pokemon,
-        flattened.
+        :param sorted_party: The focused player's already sorted party list, sorted here if not provided.
+        :param out: An optional float32 array of length INPUT_SIZE to write the vector into instead of allocating one.
+        :return: A 60-len numpy array with the HP ratios of max 12 Pokemon followed by the [Move 1 PP ratio, ...
+        Move 4 PP ratio] rows of those Pokemon, flattened.
         """
         # Store each player's Pokemon lists
-        player_pokemon = player.get_party().get_sorted_list()
+        player_pokemon = sorted_party if sorted_party is not None else player.get_party().get_sorted_list()
         other_player_pokemon = other_player.get_party().get_sorted_list()
 
-        mat = []
+        # Gather every stat and its base value; empty Pokemon and move slots divide EPSILON by 1
+        num_pokemon = 2 * POKEMON_PARTY_LIMIT
+        hps, base_hps = np.full(num_pokemon, EPSILON), np.ones(num_pokemon)
+        pps, base_pps = np.full((num_pokemon, POKEMON_MOVE_LIMIT), EPSILON), np.ones((num_pokemon, POKEMON_MOVE_LIMIT))
 
-        def fill_rows(pokemon_list: List[Pokemon]):
+        def fill_rows(pokemon_list: List[Pokemon], start_row: int):
             """
-            Fills a list of rows with Pokemon stats.
+            Fills the rows of the HP and PP arrays with Pokemon stats.
             :param pokemon_list: A list of Pokemon.
+            :param start_row: The row of the first Pokemon in the list.
             """
-            for pkmn in pokemon_list:
-                row = []
-
+            for r, pkmn in enumerate(pokemon_list, start_row):
                 # Add HP component
-                hp_comp = pkmn.get_hp() / pkmn.get_base_hp()
-                row.append(hp_comp)
+                hps[r] = pkmn.get_hp()
+                base_hps[r] = pkmn.get_base_hp()
 
                 # Add move components
                 move_list = pkmn.get_move_bank().get_as_list()
-                for move in move_list:
-                    move_comp = move.get_pp() / move.get_base_pp()
-                    row.append(move_comp)
-                # Fill remaining moves with 0
-                for _ in range(POKEMON_MOVE_LIMIT - len(move_list)):
-                    row.append(EPSILON)
-
-                # Add row to matrix
-                mat.append(row)
-
-        def fill_empty(num: int):
-            for _ in range(num):
-                mat.append([EPSILON, EPSILON, EPSILON, EPSILON, EPSILON])
+                pps[r, :len(move_list)] = [move.get_pp() for move in move_list]
+                base_pps[r, :len(move_list)] = [move.get_base_pp() for move in move_list]
 
         # Fill rows
-        fill_rows(player_pokemon)
-        fill_empty(POKEMON_PARTY_LIMIT - len(player_pokemon))
-        fill_rows(other_player_pokemon)
-        fill_empty(POKEMON_PARTY_LIMIT - len(other_player_pokemon))
+        fill_rows(player_pokemon, 0)
+        fill_rows(other_player_pokemon, POKEMON_PARTY_LIMIT)
+
+        # Compute the HP and PP ratios straight into their sections of the vector
+        if out is None:
+            out = np.empty(INPUT_SIZE, dtype=np.float32)
+        hp_ratios, pp_ratios = Predictor._split_input(out)
+        np.divide(hps, base_hps, out=hp_ratios)
+        np.divide(pps, base_pps, out=pp_ratios)
 
-        return np.array(mat).flatten()
+        return out
 
     @staticmethod
-    def _make_actual_output_list(player: Player, node: Any) -> np.ndarray:
+    def _make_actual_output_list(player: Player, node: Any, sorted_party: Optional[List[Pokemon]] = None) -> np.ndarray:
         """
         Creates a list of actual output values from a player object and a single node.
         :param player: A Player that owns the action in the node.
         :param node: A MonteCarloNode.
+        :param sorted_party: The player's already sorted party list, sorted here if not provided.
         :return: A list of output values of length OUTPUT_SIZE (31).
         """
 
-        # Get list of Pokemon
-        player_pokemon = player.get_party().get_as_list()
+        # Map each Pokemon ID to its position in the sorted party to retain order
+        if sorted_party is None:
+            sorted_party = player.get_party().get_sorted_list()
+        id_to_sorted_idx = {pkmn.get_id(): i for i, pkmn in enumerate(sorted_party)}
 
-        # Calculate switch probabilities
-        switch_probs = [EPSILON] * len(player_pokemon)
-        for child in node.children:
-            if child.action_type == 0:  # SWITCH
-                pkmn_id = child.action_descriptor
-                switch_idx = 0
-                for i, pkmn in enumerate(player_pokemon):
-                    if pkmn.get_id() == pkmn_id:
-                        switch_idx = i
-                switch_probs[switch_idx] = child.outcome / node.outcome
-        # Create a tuple of switch probability / Pokemon values
-        pokemon_switch_tuple: List[Tuple[float, Pokemon]] = []
-        for i, switch_prob in enumerate(switch_probs):
-            pokemon_switch_tuple.append((switch_prob, player_pokemon[i]))
-        # Sort the tuple by Pokemon ID to retain order
-        pokemon_switch_tuple.sort(key=lambda v: v[1].get_id())
-        # Remake switch_probs in order
-        switch_probs = [tup[0] for tup in pokemon_switch_tuple]
-        # Add extra probs in case of short party
-        for _ in range(POKEMON_PARTY_LIMIT - len(player_pokemon)):
-            switch_probs.append(EPSILON)
-
-        # Add attack moves of every Pokemon
-        pkmn_id_to_move_prob_map = {}
+        # Share one reciprocal across every child's probability
+        inv_outcome = 1.0 / node.outcome if node.outcome else 0.0
+
+        # Preallocate the output so that missing switches and moves are already filled
+        out = np.full(OUTPUT_SIZE, EPSILON, dtype=np.float32)
+        switch_probs = out[:POKEMON_PARTY_LIMIT]
+        move_probs = out[POKEMON_PARTY_LIMIT:-1].reshape(POKEMON_PARTY_LIMIT, POKEMON_MOVE_LIMIT)
+
+        # Add switch probabilities and the attack moves of every Pokemon
         for child in node.children:
-            if child.action_type == 0:  # ATTACK
-                pkmn_id = child.detokenize_child()
-                move_idx = child.action_descriptor
-                if pkmn_id not in pkmn_id_to_move_prob_map:
-                    pkmn_id_to_move_prob_map[pkmn_id] = [EPSILON] * POKEMON_MOVE_LIMIT
-                pkmn_id_to_move_prob_map[pkmn_id][move_idx] = child.outcome / node.outcome
-        # Create a list of moves for all Pokemon and then traverse the sorted Pokemon list, adding the prob of each move
-        # one by one.
-        move_probs = []
-        for pkmn in player.get_party().get_sorted_list():
-            pkmn_id = pkmn.get_id()
-            move_probs_for_pkmn = []
-            if pkmn_id in pkmn_id_to_move_prob_map:
-                for move_prob in pkmn_id_to_move_prob_map[pkmn_id]:
-                    move_probs_for_pkmn.append(move_prob)
-            while len(move_probs_for_pkmn) < 4:
-                move_probs_for_pkmn.append(EPSILON)
-            move_probs += move_probs_for_pkmn
-        while len(move_probs) < POKEMON_PARTY_LIMIT * POKEMON_MOVE_LIMIT:
-            move_probs += [EPSILON] * POKEMON_MOVE_LIMIT
-
-        outcome_list = [node.outcome]
-
-        mat = switch_probs + move_probs + outcome_list
-        return np.array(mat)
+            if child.action_type == MonteCarloActionType.SWITCH:
+                sorted_idx = id_to_sorted_idx.get(child.action_descriptor)
+                if sorted_idx is not None:
+                    switch_probs[sorted_idx] = child.outcome * inv_outcome
+            elif child.action_type == MonteCarloActionType.ATTACK:
+                sorted_idx = id_to_sorted_idx.get(child.detokenize_child())
+                if sorted_idx is not None:
+                    move_probs[sorted_idx, child.action_descriptor] = child.outcome * inv_outcome
+
+        # Add the outcome value
+        out[-1] = node.outcome
+
+        return out
@@ -28,6 +28,29 @@ class PredictorTestSuite(unittest.TestCase):
         # Simply ensure it's the correct length
         self.assertEqual(60, len(input_vector))
 
+    def test_make_input_vector_hp_section(self):
+        # Create player objects
+        party1 = get_party('venusaur', 'squirtle')
+        player1 = Player('test', party1, model=RandomModel())
+        party2 = get_party('charmander', 'blastoise')
+        player2 = Player('test2', party2, model=RandomModel())
+
+        # Play a turn
+        battle = Battle(player1, player2, 0)
+        battle.play_turn()
+
+        # Split the input vector into its HP and PP sections
+        input_vector = Predictor._make_input_vector(player1, player2)
+        hp_ratios, pp_ratios = Predictor._split_input(input_vector)
+
+        # Ensure the HP section lines up with the sorted party of each player
+        self.assertEqual((12,), hp_ratios.shape)
+        self.assertEqual((12, 4), pp_ratios.shape)
+        for i, pokemon in enumerate(player1.get_party().get_sorted_list()):
+            self.assertAlmostEqual(pokemon.get_hp() / pokemon.get_base_hp(), hp_ratios[i], places=5)
+        for i, pokemon in enumerate(player2.get_party().get_sorted_list()):
+            self.assertAlmostEqual(pokemon.get_hp() / pokemon.get_base_hp(), hp_ratios[6 + i], places=5)
+
     def test_make_actual_output_list(self):
         # Create player objects
         party1 = get_party('venusaur', 'squirtle')